@@ -1,31 +1,51 @@
+import glob
 import logging
 import os
 import re
+import shutil
 import sys
+import tempfile
+import threading
 import time
 import html
+from calendar import timegm
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from email.utils import formatdate
+from functools import lru_cache
 from typing import cast
-from hashlib import md5
+from hashlib import blake2b
 from typing import Optional
 
 import feedparser
 import requests
 from apscheduler.schedulers.blocking import BlockingScheduler
 from apscheduler.triggers.cron import CronTrigger
-from bs4 import BeautifulSoup
-from peewee import SqliteDatabase, Model, TextField, IntegerField
+from bs4 import BeautifulSoup, SoupStrainer
+from peewee import SqliteDatabase, Model, TextField, IntegerField, chunked
 from requests import RequestException
 from requests.adapters import HTTPAdapter
 from urllib3.util import Retry
-from urllib.parse import urlparse
+from urllib.parse import urlsplit, urlunsplit
 
 BOT_TOKEN = os.environ['BOT_TOKEN']
 TELEGRAM_API_URL = f'https://api.telegram.org/bot{BOT_TOKEN}'
 TELEGRAM_CHANNEL = os.environ.get('TELEGRAM_CHANNEL', '@dday_it_feed')
+# Telegram allows about 20 messages per minute in the same chat
+TELEGRAM_SEND_INTERVAL = 3
 
 UA = 'DDay.it News Telegram (+https://github.com/turbostar190/dday-telegram)'
-feedparser.USER_AGENT = UA
+FEED_URL = 'https://www.dday.it/rss'
+
+IMG_TAG_RE = re.compile(r'<img\b[^>]*>', re.IGNORECASE)
+# The body can't contain another <a, so unclosed anchors don't each scan to the end of the string
+A_TAG_RE = re.compile(r'<a\b[^>]*>(?:(?!<a\b|</a>).)*</a>', re.IGNORECASE | re.DOTALL)
+WHITESPACE_RE = re.compile(r'\s+')
+
+# Cheap check on the raw page for a class attribute that TAGS_STRAINER could match
+TAGS_CLASS_RE = re.compile(rb'class\s*=\s*["\']?[^"\'>]*\b(?:article-category-)?tags\b')
+# The strainer sees the raw class attribute, so match single classes inside it
+TAGS_STRAINER = SoupStrainer(['section', 'div'], class_=re.compile(r'(^|\s)(article-category-tags|tags)(\s|$)'))
 
 DATABASE_PATH = os.environ.get('DATABASE_PATH', 'dday.db')
 
@@ -35,14 +55,27 @@ logger = logging.getLogger(__name__)
 
 logger.info('Database path: ' + DATABASE_PATH)
 
-db = SqliteDatabase(DATABASE_PATH)
+db = SqliteDatabase(DATABASE_PATH, pragmas={
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -8000,  # 8 MB
+    'temp_store': 'memory',
+})
+
+# Shared HTTP session, so that connections to dday.it and Telegram are kept alive.
+# Status retries only cover idempotent methods (urllib3's default): retrying a sendPhoto could post it twice
+session = requests.Session()
+session.headers['User-Agent'] = UA
+session.mount('https://', HTTPAdapter(max_retries=Retry(total=2, backoff_factor=0.3,
+                                                        status_forcelist=[429, 502, 503, 504]),
+                                      pool_connections=4, pool_maxsize=8))
 
 
 class Article(Model):
     id = IntegerField(primary_key=True)
     title = TextField()
     description = TextField()
-    link = TextField()
+    link = TextField(unique=True)
     image = TextField()
     published = IntegerField()
     updated = IntegerField()
@@ -52,6 +85,14 @@ class Article(Model):
         database = db
 
 
+class KeyValue(Model):
+    key = TextField(primary_key=True)
+    value = TextField(null=True)
+
+    class Meta:
+        database = db
+
+
 @dataclass
 class TelegramMessage:
     title: str
@@ -62,97 +103,172 @@ class TelegramMessage:
 
 
 def parse_url(entry) -> str:
-    url = entry.links[0].href
-    
-    parsed = urlparse(url)
-    if ("www" not in parsed.netloc):
-        parsed = parsed._replace(netloc="www." + parsed.netloc)
-    return parsed.geturl()
+    return normalize_url(entry.links[0].href)
+
+
+@lru_cache(maxsize=256)
+def normalize_url(url: str) -> str:
+    scheme, netloc, path, query, fragment = urlsplit(url)
+    if not netloc.startswith('www.'):
+        netloc = 'www.' + netloc
+    return urlunsplit((scheme, netloc, path, query, fragment))
+
+
+def get_value(key: str) -> Optional[str]:
+    row = KeyValue.get_or_none(KeyValue.key == key)
+    return row.value if row else None
+
+
+def set_value(key: str, value: Optional[str]):
+    KeyValue.replace(key=key, value=value).execute()
 
 
 def check():
     logger.info('Checking...')
 
-    latest_article = Article.select().order_by(Article.updated.desc()).first()
-    last_updated = time.gmtime(latest_article.updated) if latest_article else None
-
-    feed = feedparser.parse('https://www.dday.it/rss', modified=last_updated)
-    logger.info(f'Feed {len(feed.entries)} entries, version {feed.version}, status {feed.status}, bozo {feed.bozo}')
-    if feed.status == 304:
-        logger.debug('Feed not modified')
+    # Conditional GET, using the validators returned by the last fully processed feed
+    etag = get_value('feed_etag')
+    modified = get_value('feed_modified')
+    if not etag and not modified:
+        latest_article = Article.select().order_by(Article.updated.desc()).first()
+        modified = formatdate(latest_article.updated, usegmt=True) if latest_article else None
+
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if modified:
+        headers['If-Modified-Since'] = modified
+
+    # Fetched through the shared session, feedparser only parses the body
+    resp = session.get(FEED_URL, headers=headers, timeout=10)
+    if resp.status_code == 304:
+        logger.info('Feed not modified')
         return
+    resp.raise_for_status()
+
+    feed = feedparser.parse(resp.content, response_headers={k.lower(): v for k, v in resp.headers.items()})
+    logger.info(f'Feed {len(feed.entries)} entries, version {feed.version}, status {resp.status_code}, bozo {feed.bozo}')
     if feed.bozo:
         logger.exception('Error parsing feed: %s', str(feed.bozo_exception))
         sys.exit(1)
         return
 
-    if Article.select().count() == 0:
+    if not Article.select().exists():
         logger.debug('No articles in database, running first run')
         first_run(feed)
+        save_feed_validators(resp)
         return
 
-    for entry in reversed(feed.entries):
-        parsed_url = parse_url(entry)
-        article = Article.get_or_none(link=parsed_url)
+    # Fetch all the known articles in the feed with a single query
+    links = [parse_url(entry) for entry in feed.entries]
+    existing = {
+        article.link: article
+        for article in Article.select(Article.id, Article.link, Article.updated, Article.telegram_message_id)
+                              .where(Article.link.in_(links))
+    }
+
+    to_process = []
+    queued = set()
+    for entry, parsed_url in reversed(list(zip(feed.entries, links))):
+        # The same article can be listed more than once, only send it the first time
+        if parsed_url in queued:
+            logger.debug(f'Skipping duplicate entry: {parsed_url}')
+            continue
+        article = existing.get(parsed_url)
         logger.debug(f'Checking article: {parsed_url}')
 
-        if (not article): # or (int(time.mktime(entry.updated_parsed)) > article.updated) # skip updated check for now
-            process_new_article(entry)
+        if (not article): # or (timegm(entry.updated_parsed) > article.updated) # skip updated check for now
+            to_process.append((entry, parsed_url, article))
+            queued.add(parsed_url)
+
+    # Article pages and images are all fetched concurrently, messages are still sent one at a time in feed order
+    all_processed = True
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        details = [executor.submit(fetch_article_details, link) for _, link, _ in to_process]
+        # Articles can share the same image, download it only once
+        images = {}
+        for entry, _, _ in to_process:
+            image_url = html.unescape(entry.links[1].href)
+            if image_url not in images:
+                images[image_url] = executor.submit(download_image, image_url)
+
+        for (entry, link, article), article_details in zip(to_process, details):
+            image = images[html.unescape(entry.links[1].href)]
+            message = prepare_message(entry, link, article_details.result(), image.result())
+            if not process_new_article(entry, message, article):
+                all_processed = False
+
+    # Otherwise the next check must download the feed again, so that failed articles are retried
+    if all_processed:
+        save_feed_validators(resp)
 
     logger.info('Done!')
 
 
+def save_feed_validators(resp: requests.Response):
+    with db.atomic():
+        set_value('feed_etag', resp.headers.get('ETag'))
+        set_value('feed_modified', resp.headers.get('Last-Modified'))
+
+
 def first_run(feed):
     logger.info('First run, populating database...')
-    for entry in reversed(feed.entries):
-        article = Article(
-            post_id=None,
-            title=entry.title.strip(),
-            description=strip_description(entry.summary),
-            link=parse_url(entry),
-            image=entry.links[1].href,
-            published=int(time.mktime(entry.published_parsed)),
-            updated=int(time.mktime(entry.updated_parsed)),
-            telegram_message_id=None
-        )
-        article.save()
+    rows = [
+        {
+            'title': entry.title.strip(),
+            'description': strip_description(entry.summary),
+            'link': parse_url(entry),
+            'image': entry.links[1].href,
+            'published': timegm(entry.published_parsed),
+            'updated': timegm(entry.updated_parsed),
+            'telegram_message_id': None,
+        }
+        for entry in reversed(feed.entries)
+    ]
+    with db.atomic():
+        # Keep each statement well below SQLite's bound parameters limit,
+        # and skip links listed more than once instead of failing on the unique index
+        for batch in chunked(rows, 100):
+            Article.insert_many(batch).on_conflict_ignore().execute()
     logger.info('Done!')
 
 
-def process_new_article(entry):
-    details = fetch_article_details(parse_url(entry))
-    
-    message = TelegramMessage(
+def prepare_message(entry, link: str, details: dict, image: Optional[str]) -> TelegramMessage:
+    return TelegramMessage(
         title=entry.title.strip(),
         description=strip_description(entry.summary),
-        link=parse_url(entry),
+        link=link,
         # image=html.unescape(entry.links[1].href),
-        image=download_image(html.unescape(entry.links[1].href)) or "",
+        image=image or "",
         tags=details['tags'],
     )
 
-    # Article already exists
-    if article := Article.get_or_none(link=parse_url(entry)):
-        article: Article
 
-        logger.info(f'Updating article: {parse_url(entry)} (old: {article.link})')
+def process_new_article(entry, message: TelegramMessage, article: Optional[Article] = None) -> bool:
+    published_ts = timegm(entry.published_parsed)
+    updated_ts = timegm(entry.updated_parsed)
+
+    # Article already exists
+    if article:
+        logger.info(f'Updating article: {message.link} (old: {article.link})')
         if not article.telegram_message_id:
             logger.warning('Article has no telegram_message_id, skipping')
             # fix for articles added on the first run and never sent
-            article.__setattr__('updated', int(time.mktime(entry.updated_parsed)))
+            article.__setattr__('updated', updated_ts)
             article.save()
-            return
+            return True
         
         try:
             send_message(message, article.telegram_message_id, entry.updated)
         except RequestException:
             logger.exception('Error updating message')
-            return  # so that it's retried later
+            return False  # so that it's retried later
         
         article.title = entry.title
-        article.__setattr__('link', parse_url(entry))
-        article.__setattr__('updated', int(time.mktime(entry.updated_parsed)))
+        article.__setattr__('link', message.link)
+        article.__setattr__('updated', updated_ts)
         article.save()
+        return True
 
     # Otherwise assume that it's new
     else:
@@ -161,29 +277,31 @@ def process_new_article(entry):
             message_id = send_message(message)
         except RequestException:
             logger.exception('Error sending message')
-            return  # so that it's retried later
+            return False  # so that it's retried later
         Article.create(
             title=message.title,
             description=message.description,
             link=message.link,
             image=message.image,
-            published=time.mktime(entry.published_parsed),
-            updated=time.mktime(entry.updated_parsed),
+            published=published_ts,
+            updated=updated_ts,
             telegram_message_id=message_id
         )
+        return True
 
 
 def fetch_article_details(link: str) -> dict:
-    resp = requests.get(
-        link,
-        headers={
-            'User-Agent': UA
-        },
-        timeout=10
-    )
+    resp = session.get(link, timeout=10)
     resp.raise_for_status()
 
-    soup = BeautifulSoup(resp.text, 'html.parser')
+    # Don't parse the page if no class attribute can match TAGS_STRAINER, which does the exact match
+    if not TAGS_CLASS_RE.search(resp.content):
+        return {
+            'tags': [],
+        }
+
+    # Only build the tree for the tag containers, not the whole page
+    soup = BeautifulSoup(resp.content, 'lxml', parse_only=TAGS_STRAINER)
 
     tags = []
 
@@ -198,7 +316,7 @@ def fetch_article_details(link: str) -> dict:
             tags = categories.find_all('span', class_='tag')
 
     if len(tags) > 0:
-        tags = [re.sub(r"\s+", "", tag.get_text(), flags=re.UNICODE).replace("-", "") for tag in tags] # remove spaces and dashes
+        tags = [WHITESPACE_RE.sub("", tag.get_text()).replace("-", "") for tag in tags] # remove spaces and dashes
 
     return {
         'tags': tags,
@@ -209,59 +327,76 @@ def download_image(image_url: str) -> Optional[str]:
     if not image_url:
         return None
     try:
-        session = requests.Session()
-        retries = Retry(total=2, status_forcelist=[502, 503, 504])
-        session.mount('https://', HTTPAdapter(max_retries=retries))
-        resp = session.get(image_url, timeout=10)
-        resp.raise_for_status()
-        filename = 'images/' + md5(image_url.encode('utf-8')).hexdigest()
-        with open(filename, 'wb') as f:
-            f.write(resp.content)
-        session.close()
+        filename = 'images/' + blake2b(image_url.encode('utf-8'), digest_size=16).hexdigest()
+        if os.path.exists(filename):
+            return filename
+        # Download to a temporary file of our own, so that a partial download is never reused
+        # and concurrent downloads of the same image don't write to the same file
+        fd, tmp_filename = tempfile.mkstemp(dir='images', suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f, session.get(image_url, timeout=10, stream=True) as resp:
+                resp.raise_for_status()
+                for chunk in resp.iter_content(chunk_size=64 * 1024):
+                    f.write(chunk)
+            os.replace(tmp_filename, filename)
+        except BaseException:
+            os.unlink(tmp_filename)
+            raise
         return filename
     except (Exception,):
         logger.exception('Error downloading image')
         return None
 
 
+last_send_time = 0.0
+
+
+def wait_for_send_slot():
+    global last_send_time
+    delay = last_send_time + TELEGRAM_SEND_INTERVAL - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+    last_send_time = time.monotonic()
+
+
 def send_message(message: TelegramMessage, telegram_message_id=None, updated_time=None) -> int:
-    msg = ''
+    wait_for_send_slot()
+
+    parts = [f'<strong>{telegram_escape(message.title)}</strong>']
 
-    msg += f'<strong>{telegram_escape(message.title)}</strong>'
-    
     if message.tags:
-        msg += '\n'
-        for tag in message.tags:
-            msg += f'#{tag} '
+        parts.append('\n' + ' '.join(f'#{tag}' for tag in message.tags))
 
     if message.description:
-        msg += f'\n\n<i>{telegram_escape(message.description)}</i>'
+        parts.append(f'\n\n<i>{telegram_escape(message.description)}</i>')
 
-    msg += f'\n\n📰 <a href="{message.link}">Leggi articolo</a>'
+    parts.append(f'\n\n📰 <a href="{message.link}">Leggi articolo</a>')
 
     if telegram_message_id and updated_time:
-        # msg += f'\n\n<i>EDIT: {time.strftime("%d/%m/%Y %H:%M", updated_time)}</i>'
-        msg += f'\n\n<i>EDIT: {updated_time}</i>'
+        # parts.append(f'\n\n<i>EDIT: {time.strftime("%d/%m/%Y %H:%M", updated_time)}</i>')
+        parts.append(f'\n\n<i>EDIT: {updated_time}</i>')
 
         payload = {
             'chat_id': TELEGRAM_CHANNEL,
             'message_id': telegram_message_id,
-            'caption': msg,
+            'caption': ''.join(parts),
             'parse_mode': 'HTML',
         }
-        resp = requests.post(f'{TELEGRAM_API_URL}/editMessageCaption', json=payload)
+        resp = session.post(f'{TELEGRAM_API_URL}/editMessageCaption', json=payload, timeout=10)
     else:
         payload = {
             'chat_id': TELEGRAM_CHANNEL,
-            'caption': msg,
+            'caption': ''.join(parts),
             'parse_mode': 'HTML',
             # 'photo': message.image,
         }
-        resp = requests.post(f'{TELEGRAM_API_URL}/sendPhoto',
-                             data=payload,
-                             files={
-                                 'photo': open(message.image, 'rb')
-                             })
+        with open(message.image, 'rb') as photo:
+            resp = session.post(f'{TELEGRAM_API_URL}/sendPhoto',
+                                data=payload,
+                                files={
+                                    'photo': photo
+                                },
+                                timeout=30)
 
     # Error while editing
     if resp.status_code != 200 and telegram_message_id:
@@ -279,35 +414,74 @@ def send_message(message: TelegramMessage, telegram_message_id=None, updated_tim
     return message_id
 
 def telegram_escape(text: str) -> str:
-    return html.escape(text)
+    return html.escape(text, quote=False)  # quotes don't need escaping outside of attributes
     # return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
 
 def strip_description(description: str) -> str:
-    description = re.sub(r'<img.*/>', '', description)
-    description = re.sub(r'<a.*/a>', '', description)
-    description = re.sub(r'\s+', ' ', description)
+    description = IMG_TAG_RE.sub('', description)
+    if '</a>' in description.lower():
+        description = A_TAG_RE.sub('', description)
+    description = WHITESPACE_RE.sub(' ', description)
     return description
 
 def clean():
     logger.info('Cleaning old articles')
-    # Keep the last 200 articles
-    Article.delete().where(Article.id.not_in(
-        Article.select(Article.id).order_by(Article.id.desc()).limit(200)
-    )).execute()
+    # Keep the last 200 articles: delete everything up to the 201st newest id
+    cutoff = Article.select(Article.id).order_by(Article.id.desc()).offset(200).limit(1).scalar()
+    if cutoff is not None:
+        Article.delete().where(Article.id <= cutoff).execute()
 
     logger.info('Cleaning old images')
-    for filename in os.listdir('images'):
-        os.remove(os.path.join('images', filename))
+    # Swap in an empty folder right away and delete the old one in the background
+    try:
+        os.rename('images', f'images.old.{int(time.time())}')
+        os.makedirs('images', exist_ok=True)
+    except OSError:
+        # e.g. images is a mount point, empty it in place
+        with os.scandir('images') as it:
+            for entry in it:
+                os.unlink(entry.path)
+    threading.Thread(target=remove_old_images, daemon=True).start()
+
+
+def remove_old_images():
+    # Also picks up folders left behind if the process exited mid-delete
+    for path in glob.glob('images.old.*'):
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def remove_duplicate_links():
+    # Older versions could store the same link more than once, which would make creating the unique index fail.
+    # Keep one row per link, preferring the one that was sent to Telegram and then the newest one.
+    if not db.table_exists('article'):
+        return
+    cursor = db.execute_sql('''
+        DELETE FROM article WHERE EXISTS (
+            SELECT 1 FROM article AS other
+            WHERE other.link = article.link
+              AND ((other.telegram_message_id IS NOT NULL) > (article.telegram_message_id IS NOT NULL)
+                   OR ((other.telegram_message_id IS NOT NULL) = (article.telegram_message_id IS NOT NULL)
+                       AND other.id > article.id))
+        )
+    ''')
+    if cursor.rowcount > 0:
+        logger.info(f'Removed {cursor.rowcount} duplicate articles')
 
 
 if __name__ == '__main__':
-    db.create_tables([Article])
+    remove_duplicate_links()
+    db.create_tables([Article, KeyValue])
     os.makedirs('images', exist_ok=True)
 
     clean()
     check()
 
-    scheduler = BlockingScheduler()
+    # Never overlap runs and merge missed runs into one, but don't drop a run that starts a bit late
+    scheduler = BlockingScheduler(job_defaults={
+        'coalesce': True,
+        'max_instances': 1,
+        'misfire_grace_time': 60,
+    })
     scheduler.add_job(check, trigger=CronTrigger(minute='*/9'))
     scheduler.add_job(clean, trigger=CronTrigger(minute='5', hour='1'))
 